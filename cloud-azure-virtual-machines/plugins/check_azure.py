@@ -18,6 +18,12 @@ import datetime
 import argparse
 import os
 import sys
+import threading
+import time
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 import requests.packages.urllib3
 import nagiosplugin
 from nagiosplugin import Cookie
@@ -35,11 +41,46 @@ requests.packages.urllib3.disable_warnings(SNIMissingWarning)
 
 MINUTE_IN_SECONDS = 60
 
+# Share of the check timeout given to each Azure call, the metrics call gets
+# whatever is left. A margin is kept back so our own timeouts fire before
+# nagiosplugin aborts the whole check.
+DEADLINE_MARGIN = 0.9
+AUTH_SHARE = 0.25
+REGISTER_SHARE = 0.25
+
+# Number of previous latencies kept per call to work out the hedge cutoff,
+# hedging only starts once half of them have been collected
+LATENCY_SAMPLES = 20
+
+NO_METRIC_DATA = (
+    "No metric data was found. "
+    "This may be due to the check being run too "
+    "quickly after the last run"
+)
+NO_RESOURCE_DATA = NO_METRIC_DATA + " also check resource group or resource."
+
 
 class PluginError(Exception):
     pass
 
 
+class RequestTimeout(PluginError):
+    pass
+
+
+class Deadline(object):
+    """Track the time left out of the overall check budget"""
+    def __init__(self, seconds):
+        self.expires = time.time() + seconds
+
+    def remaining(self):
+        return max(self.expires - time.time(), 0)
+
+    def share(self, fraction):
+        """Return a fraction of the remaining budget in seconds"""
+        return self.remaining() * fraction
+
+
 class Metric(nagiosplugin.Resource):
     def probe(self):
         dispatch_mode = create_dispatch_table()
@@ -53,7 +94,9 @@ class Metric(nagiosplugin.Resource):
                 raise PluginError("Missing the -M metric argument")
 
         try:
-            metric_result, mode, uom = get_metric(dispatch_mode[args.mode])
+            metric_result, mode, uom, latencies = get_metric(
+                dispatch_mode[args.mode]
+            )
         except KeyError:
             raise PluginError("Mode {} does not exist".format(args.mode))
 
@@ -61,6 +104,12 @@ class Metric(nagiosplugin.Resource):
             mode, int(metric_result), context=args.mode, uom=uom
         )
 
+        for name in sorted(latencies):
+            yield nagiosplugin.Metric(
+                '{}_time'.format(name), round(latencies[name], 3),
+                context='latency', uom='s'
+            )
+
 
 def get_args():
     parser = argparse.ArgumentParser(
@@ -123,12 +172,28 @@ def get_args():
         '-u', dest='uom', default='',
         type=str, help="The metric type"
     )
+    parser.add_argument(
+        '-T', dest='timeout', default=50,
+        type=int, help="Seconds before the check times out (default 50)"
+    )
+    parser.add_argument(
+        '--hedge', dest='hedge', type=int,
+        help="Send a duplicate request if the first has not answered by " +
+        "this percentile of previous latencies (e.g. 95)"
+    )
     parser.add_argument(
         '--debug', dest='debug', action='store_true',
         help="Output more detail for debugging purposes"
     )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    if args.timeout <= 0:
+        parser.error("-T timeout must be greater than 0")
+    if args.hedge is not None and not 1 <= args.hedge <= 99:
+        parser.error("--hedge percentile must be between 1 and 99")
+
+    return args
 
 
 def create_dispatch_table():
@@ -472,17 +537,32 @@ def get_metric(args_list):
     uom = args_list[1]
     aggregation = args_list[2]
     mode = args_list[3]
-    metrics_data = setup_get_request(provider, aggregation, mode)
+    metrics_data, latencies = setup_get_request(provider, aggregation, mode)
     metric_value = get_metric_value(aggregation, metrics_data)
-    return metric_value, mode, uom
+    return metric_value, mode, uom, latencies
 
 
 def setup_get_request(provider, aggregation, mode):
     """Setup the credentials to access the azure service"""
-    credentials = ServicePrincipalCredentials(
-        client_id=args.client,
-        secret=args.secret,
-        tenant=args.tenant
+    calls = TimedCalls(args.timeout * DEADLINE_MARGIN)
+    try:
+        return get_metrics_data(calls, provider, aggregation, mode)
+    finally:
+        calls.save()
+
+
+def get_metrics_data(calls, provider, aggregation, mode):
+    """Make the timed Azure calls and return the metrics data
+    along with the latency of each call"""
+    credentials = calls.call(
+        'auth',
+        calls.deadline.share(AUTH_SHARE),
+        lambda timeout: ServicePrincipalCredentials(
+            client_id=args.client,
+            secret=args.secret,
+            tenant=args.tenant,
+            timeout=timeout
+        )
     )
 
     client = MonitorClient(
@@ -495,7 +575,15 @@ def setup_get_request(provider, aggregation, mode):
         args.subscription
     )
 
-    resource_client.providers.register('Microsoft.Insights')
+    # Registering is a write, so it is never hedged
+    calls.call(
+        'register',
+        calls.deadline.share(REGISTER_SHARE),
+        lambda timeout: resource_client.providers.register(
+            'Microsoft.Insights', timeout=timeout
+        ),
+        hedge=False
+    )
 
     # Creating the resource ID of the system also acts as an endpoint
     resource_id = (
@@ -504,34 +592,6 @@ def setup_get_request(provider, aggregation, mode):
         'providers/{2}/{3}'
     ).format(args.subscription, args.resource, provider, args.hostaddress)
 
-    if args.debug:
-        sys.stderr.write("Available Resource Groups:\n")
-        for item in resource_client.resource_groups.list():
-            print_item(item)
-
-        sys.stderr.write("Available VMs:\n");
-        compute_client = ComputeManagementClient(credentials, args.subscription)
-        for vm in compute_client.virtual_machines.list_all():
-            sys.stderr.write("\t{}\n".format(vm.name))
-
-        sys.stderr.write( "Available Metric Definitions\n" )
-        for metric in client.metric_definitions.list(resource_id):
-            sys.stderr.write("\t{}: id={}, unit={}\n".format(
-                metric.name.localized_value,
-                metric.name.value,
-                metric.unit
-            ))
-# listing available metrics is not useful as without a filter it only shows 
-# the first available and not all (as per the docs)
-#        print "Available Metrics"
-#        for metric in client.metrics.list(resource_id):
-#            # azure.monitor.models.MetricDefinition
-#            print("\t{}: id={}, unit={}".format(
-#                metric.name.localized_value,
-#                metric.name.value,
-#                metric.unit
-#            ))
-
     end_time = datetime.datetime.utcnow()
     start_time = update_time_state(end_time)
     period = end_time - start_time
@@ -545,55 +605,286 @@ def setup_get_request(provider, aggregation, mode):
         "timeGrain eq duration'PT{}M'".format(int(period.total_seconds() / MINUTE_IN_SECONDS))
     ])
 
+    # The result is paged, so read it inside the call to make the request
+    # happen within the time budget rather than when the caller iterates
+    try:
+        # Different metrics can take very different times to query, so
+        # each keeps its own samples for the hedge cutoff
+        metrics_data = calls.call(
+            'metrics',
+            calls.deadline.remaining(),
+            lambda timeout: list(client.metrics.list(
+                resource_id,
+                filter=filter,
+                timeout=timeout
+            )),
+            key='metrics_{}'.format(mode)
+        )
+    except ErrorResponseException:
+        raise PluginError(NO_RESOURCE_DATA)
 
-    # if we output the info here then we need to make another call to get the data
-    # else the iterator uses up all the info and returns nothing to the caller
     if args.debug:
-        metrics_data = client.metrics.list(
-            resource_id,
-            filter=filter
-        )
+        # Listing is only for diagnostics, so it gets what is left of the
+        # budget and a timeout here does not lose the metric. The listing
+        # is returned rather than written so a listing left running after
+        # a timeout cannot interleave with the output below.
+        try:
+            sys.stderr.write(calls.call(
+                'debug',
+                calls.deadline.remaining(),
+                lambda timeout: get_debug_info(
+                    credentials, client, resource_client, resource_id,
+                    timeout
+                ),
+                hedge=False,
+                record=False
+            ))
+        except RequestTimeout as error:
+            sys.stderr.write("{}\n".format(error))
+
         sys.stderr.write("Metric filter: "+filter+"\n")
         sys.stderr.write("Metric data returned:\n")
         for metric in metrics_data:
             for data in metric.data:
                 sys.stderr.write("\t{}: {}\n".format(data.time_stamp, data.total))
 
-    metrics_data = client.metrics.list(
-        resource_id,
-        filter=filter
-    )
+    return metrics_data, calls.latencies
+
+
+def get_debug_info(credentials, client, resource_client, resource_id,
+                   timeout):
+    """Return a listing of the resources and metric definitions available"""
+    out = StringIO()
+    out.write(u"Available Resource Groups:\n")
+    for item in resource_client.resource_groups.list(timeout=timeout):
+        print_item(item, out)
+
+    out.write(u"Available VMs:\n");
+    compute_client = ComputeManagementClient(credentials, args.subscription)
+    for vm in compute_client.virtual_machines.list_all(timeout=timeout):
+        out.write(u"\t{}\n".format(vm.name))
+
+    out.write(u"Available Metric Definitions\n")
+    for metric in client.metric_definitions.list(resource_id, timeout=timeout):
+        out.write(u"\t{}: id={}, unit={}\n".format(
+            metric.name.localized_value,
+            metric.name.value,
+            metric.unit
+        ))
+    return out.getvalue()
+# listing available metrics is not useful as without a filter it only shows 
+# the first available and not all (as per the docs)
+#        print "Available Metrics"
+#        for metric in client.metrics.list(resource_id):
+#            # azure.monitor.models.MetricDefinition
+#            print("\t{}: id={}, unit={}".format(
+#                metric.name.localized_value,
+#                metric.name.value,
+#                metric.unit
+#            ))
+
+
+class TimedCalls(object):
+    """Run Azure calls within a shared deadline, keeping the latency
+    history used for hedging in the state file"""
+    def __init__(self, budget):
+        self.deadline = Deadline(budget)
+        self.path = check_file_path()
+        self.state_name = 'latency_{0}_{1}'.format(
+            args.subscription, args.hostaddress
+        )
+        with Cookie(self.path) as cookie:
+            self.state = cookie.get(self.state_name, {})
+        self.latencies = {}
+        # Only what this run adds is saved, as other checks for the same
+        # host may have updated the state file while this one was running
+        self.new_samples = {}
+        self.new_timeouts = {}
+
+    def call(self, name, budget, func, hedge=True, record=True, key=None):
+        """Run func(timeout) within budget seconds and return its value.
+        Latency samples and timeouts are kept under key, or name if
+        not given."""
+        if budget <= 0:
+            raise RequestTimeout(
+                "No time left in the check budget for {0}".format(name)
+            )
+
+        key = key or name
+        samples = (
+            self.state.get('samples', {}).get(key, []) +
+            self.new_samples.get(key, [])
+        )
+        hedge_after = None
+        if hedge and args.hedge and len(samples) >= LATENCY_SAMPLES // 2:
+            hedge_after = percentile(samples, args.hedge)
+
+        outcome = hedged_call(func, budget, hedge_after)
+
+        if record and outcome['sample'] is not None:
+            self.new_samples.setdefault(key, []).append(
+                round(outcome['sample'], 3)
+            )
+
+        if 'timeout' in outcome:
+            timeouts = self.state.get('timeouts', {}).get(key, 0)
+            if record:
+                self.new_timeouts[key] = self.new_timeouts.get(key, 0) + 1
+            timeouts += self.new_timeouts.get(key, 0)
+            raise RequestTimeout(
+                "Timed out waiting for {0} after {1:.1f}s "
+                "({2} timeouts so far)".format(name, budget, timeouts)
+            )
+
+        if 'error' in outcome:
+            raise outcome['error']
+
+        if args.debug:
+            sys.stderr.write(
+                "Call {0} took {1:.3f}s (budget {2:.1f}s)\n".format(
+                    name, outcome['latency'], budget
+                )
+            )
+        if record:
+            self.latencies[name] = outcome['latency']
+        return outcome['value']
+
+    def save(self):
+        """Merge this run's samples and timeouts into the state file"""
+        with Cookie(self.path) as cookie:
+            state = cookie.get(self.state_name, {})
+            samples = state.setdefault('samples', {})
+            for key, new in self.new_samples.items():
+                samples[key] = (samples.get(key, []) + new)[-LATENCY_SAMPLES:]
+            timeouts = state.setdefault('timeouts', {})
+            for key, new in self.new_timeouts.items():
+                timeouts[key] = timeouts.get(key, 0) + new
+            cookie[self.state_name] = state
+
+
+def hedged_call(func, budget, hedge_after=None):
+    """Call func(timeout) in a thread, sending a duplicate if it has
+    not answered after hedge_after seconds.
+
+    Returns a dict holding the value or error of the first attempt to
+    answer, or 'timeout' if none did in time. 'latency' is how long the
+    answer took and 'sample' the latency of the first attempt to keep
+    for the hedge cutoff, so hedging does not lower the samples."""
+    deadline = Deadline(budget)
+    start_time = time.time()
+    finished = threading.Event()
+    lock = threading.Lock()
+    results = []
+
+    def attempt(primary):
+        try:
+            outcome = {'value': func(deadline.remaining())}
+        except Exception as error:
+            if is_timeout(error):
+                outcome = {'timeout': True}
+            else:
+                outcome = {'error': error}
+        outcome['primary'] = primary
+        outcome['latency'] = time.time() - start_time
+        with lock:
+            results.append(outcome)
+            finished.set()
+
+    def start(primary):
+        thread = threading.Thread(target=attempt, args=(primary,))
+        thread.daemon = True
+        thread.start()
+
+    start(True)
+    attempts = 1
+    if hedge_after is not None and hedge_after < budget:
+        if not finished.wait(hedge_after):
+            if args.debug:
+                sys.stderr.write(
+                    "No reply after {0:.3f}s, sending hedged request\n".format(
+                        hedge_after
+                    )
+                )
+            start(False)
+            attempts += 1
+
+    # A timeout from one attempt should not hide an answer from the other
+    while True:
+        with lock:
+            answered = [r for r in results if 'timeout' not in r]
+            if answered or len(results) == attempts:
+                break
+            finished.clear()
+        if not finished.wait(deadline.remaining()):
+            with lock:
+                answered = [r for r in results if 'timeout' not in r]
+            break
+
+    if answered:
+        outcome = dict(answered[0])
+    else:
+        outcome = {'timeout': True, 'latency': time.time() - start_time}
+
+    with lock:
+        primary = [r for r in results if r['primary']]
+    if not primary:
+        # The first attempt is still running, whether a hedge answered
+        # first or nothing answered at all, so the time so far is the best
+        # lower bound for its latency
+        outcome['sample'] = outcome['latency']
+    elif 'error' in primary[0]:
+        # An error says nothing about how long a good answer takes
+        outcome['sample'] = None
+    elif 'timeout' in primary[0]:
+        # Count a timeout as at least the budget so the slow tail stays
+        # in the samples
+        outcome['sample'] = max(primary[0]['latency'], budget)
+    else:
+        outcome['sample'] = primary[0]['latency']
+    return outcome
+
+
+def is_timeout(error):
+    """Check if an error, or one it wraps, is a requests timeout.
+    msrest raises ClientRequestError and msrestazure AuthenticationError
+    with the requests exception as inner_exception."""
+    while error is not None:
+        if isinstance(error, requests.exceptions.Timeout):
+            return True
+        error = getattr(error, 'inner_exception', None)
+    return False
+
 
-    return metrics_data
+def percentile(values, percent):
+    """Return the given percentile of a list of values"""
+    ordered = sorted(values)
+    index = int(round((len(ordered) - 1) * percent / 100.0))
+    return ordered[min(max(index, 0), len(ordered) - 1)]
 
-def print_item(group):
+
+def print_item(group, out=sys.stderr):
     """Print a ResourceGroup instance."""
-    sys.stderr.write("\tName: {}\n".format(group.name))
-    sys.stderr.write("\tId: {}\n".format(group.id))
-    sys.stderr.write("\tLocation: {}\n".format(group.location))
-    sys.stderr.write("\tTags: {}\n".format(group.tags))
-    print_properties(group.properties)
+    out.write(u"\tName: {}\n".format(group.name))
+    out.write(u"\tId: {}\n".format(group.id))
+    out.write(u"\tLocation: {}\n".format(group.location))
+    out.write(u"\tTags: {}\n".format(group.tags))
+    print_properties(group.properties, out)
 
-def print_properties(props):
+def print_properties(props, out=sys.stderr):
     """Print a ResourceGroup properties instance."""
     if props and props.provisioning_state:
-        sys.stderr.write("\tProperties:\n")
-        sys.stderr.write("\t\tProvisioning State: {}\n".format(props.provisioning_state))
-    sys.stderr.write("\n")
+        out.write(u"\tProperties:\n")
+        out.write(u"\t\tProvisioning State: {}\n".format(props.provisioning_state))
+    out.write(u"\n")
 
 def get_metric_value(aggregation, metrics_data):
     """Get the latest datapoint
     and return the most recent metric"""
     try:
-        item = metrics_data.next()
+        item = metrics_data[0]
         data = item.data[0]
-    except ErrorResponseException:
-        raise PluginError(
-            "No metric data was found. " +
-            "This may be due to the check being run too " +
-            "quickly after the last run " +
-            "also check resource group or resource."
-        )
+    except IndexError:
+        raise PluginError(NO_RESOURCE_DATA)
 
     if aggregation == 'Average':
         metric_result = data.average
@@ -605,11 +896,7 @@ def get_metric_value(aggregation, metrics_data):
         metric_result = data.minimum
 
     if metric_result is None:
-        raise PluginError(
-            "No metric data was found. " +
-            "This may be due to the check being run too " +
-            "quickly after the last run."
-        )
+        raise PluginError(NO_METRIC_DATA + ".")
     else:
         return metric_result
 
@@ -655,8 +942,9 @@ def main():
     args = get_args()
     check = nagiosplugin.Check(
         Metric(),
-        nagiosplugin.ScalarContext(args.mode, args.warning, args.critical))
-    check.main()
+        nagiosplugin.ScalarContext(args.mode, args.warning, args.critical),
+        nagiosplugin.ScalarContext('latency'))
+    check.main(timeout=args.timeout)
 
 
 if __name__ == '__main__':